@@ -5,13 +5,17 @@ Uses the current directory by default.
 """
 
 import argparse
-import datetime
+import concurrent.futures
+import functools
 import grp
-import pathlib
+import io
+import operator
+import os
 import pwd
 import shutil
 import stat
-import textwrap
+import sys
+import time
 from enum import Enum, unique, auto
 
 
@@ -32,8 +36,18 @@ class FileType(Enum):
     @classmethod
     def get_file_type(cls, path):
         """Get the file type of the given path."""
-        if not isinstance(path, int):
-            path = path.lstat().st_mode
+        if isinstance(path, os.DirEntry):
+            # The type reported by readdir() covers the common cases
+            # without issuing a stat() call.
+            if path.is_symlink():
+                return cls.LNK
+            if path.is_dir(follow_symlinks=False):
+                return cls.DIR
+            if path.is_file(follow_symlinks=False):
+                return cls.REG
+            path = path.stat(follow_symlinks=False).st_mode
+        elif not isinstance(path, int):
+            path = os.lstat(path).st_mode
         for path_type in cls:
             method = getattr(stat, 'S_IS' + path_type.name.upper())
             if method and method(path):
@@ -67,60 +81,138 @@ STYLES = {
     FileType.CHR: [Color.BOLD.value, Color.YELLOW.value]
 }
 
+# With --parallel, directories with more entries than this have their
+# metadata fetched concurrently. This hides stat() latency on network
+# filesystems; on local disks the pool overhead makes listings slower.
+PARALLEL_THRESHOLD = 64
+MAX_WORKERS = 32
+
+# Files in a directory usually share a handful of owners, so user and
+# group names are looked up once per id rather than once per file.
+_uid_cache = {}
+_gid_cache = {}
+
+
+def get_owner_name(uid):
+    """Get the user name for the given uid, or the uid itself if unknown."""
+    owner = _uid_cache.get(uid)
+    if owner is None:
+        try:
+            owner = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            owner = str(uid)
+        owner = _uid_cache.setdefault(uid, owner)
+    return owner
+
+
+def get_group_name(gid):
+    """Get the group name for the given gid, or the gid itself if unknown."""
+    group = _gid_cache.get(gid)
+    if group is None:
+        try:
+            group = grp.getgrgid(gid).gr_name
+        except KeyError:
+            group = str(gid)
+        group = _gid_cache.setdefault(gid, group)
+    return group
+
+
+def get_sort_key(name):
+    """Get the key used to order file names in a listing.
+
+    Leading dots and case are ignored; ties are broken by the name itself.
+
+    """
+    return name.lstrip('.').lower(), name
+
 
 class FileInfo:
     """An object in the filesystem."""
 
+    # Listings create one instance per file, so avoid a per-instance dict.
+    __slots__ = ('entry', 'path', 'file_type', 'name', 'style', 'styled_name',
+                 'filemode_str', 'num_links', 'num_links_str', 'size',
+                 'size_str', 'mtime', 'uid', 'gid', 'owner', 'group', 'sort_key',
+                 '_stat')
+
     def __init__(self, path):
         """Create a FileInfo instance and populate it with metadata.
 
         Parameters
         ----------
-        path : string
-            The path to the file. Can be relative or absolute.
+        path : string or os.DirEntry
+            The path to the file. Can be relative or absolute. If a DirEntry
+            is given, its cached type and stat information are reused.
 
         """
 
-        self.path = pathlib.Path(path)
-        self.name = self.path.name
-        self.file_type = FileType.get_file_type(self.path)
+        if isinstance(path, os.DirEntry):
+            self.entry = path
+            self.path = path.path
+            self.name = path.name
+            self._stat = None
+            self.file_type = FileType.get_file_type(path)
+        else:
+            self.entry = None
+            self.path = path
+            self.name = os.path.basename(os.path.normpath(path))
+            self._stat = os.lstat(path)
+            self.file_type = FileType.get_file_type(self._stat.st_mode)
+        self.sort_key = get_sort_key(self.name)
         self.style = STYLES[self.file_type]
         self.styled_name = "".join(self.style) + self.name + Color.END.value
 
+        # The remaining long-format attributes are only populated by
+        # get_long_info(); filemode_str doubles as the "fetched" marker.
         self.filemode_str = None
-        self.num_links = None
-        self.size = None
-        self.mtime = None
-        self.uid = None
-        self.gid = None
-        self.owner = None
-        self.group = None
 
     def __str__(self):
         return self.name
 
+    def lstat(self):
+        """Return the stat result of the file, without following symlinks.
+
+        The result is fetched once and cached for subsequent calls.
+
+        """
+
+        if self._stat is None:
+            self._stat = self.entry.stat(follow_symlinks=False)
+        return self._stat
+
     def get_long_info(self):
         """
         Fetch information used to print in long format. If the file is a
         symlink, get the info of the link rather than the target.
 
+        Returns
+        -------
+        self : FileInfo
+            This instance, so the call can be mapped over many files.
+
         """
 
-        self.filemode_str = stat.filemode(self.path.lstat().st_mode)
-        self.num_links = self.path.lstat().st_nlink
-        self.size = self.path.lstat().st_size
-        self.mtime = self.path.lstat().st_mtime
+        # Unpacking the stat result as a tuple is cheaper than reading each
+        # st_* attribute; the tuple form holds mtime in whole seconds.
+        mode, _, _, num_links, uid, gid, size, _, mtime, _ = self.lstat()
+        self.filemode_str = stat.filemode(mode)
+        self.num_links = num_links
+        self.num_links_str = str(num_links)
+        self.size = size
+        self.size_str = str(size)
+        self.mtime = mtime
 
         # We have to get the user and group names from the uid and gid,
         # since path.user() and path.group() get the info for the target
         # rather than the symlink itself.
-        self.uid = self.path.lstat().st_uid
-        self.gid = self.path.lstat().st_gid
-        self.owner = pwd.getpwuid(self.uid)[0]
-        self.group = grp.getgrgid(self.gid)[0]
+        self.uid = uid
+        self.gid = gid
+        self.owner = get_owner_name(self.uid)
+        self.group = get_group_name(self.gid)
+        return self
 
     def get_long_str(self, link_width=0, owner_width=0,
-                     group_width=0, size_width=0):
+                     group_width=0, size_width=0, this_year=None):
         """Generate a string for printing in long format.
 
         Parameters
@@ -137,28 +229,39 @@ class FileInfo:
         size_width : int
             Maximum width of the string representing the file size.
 
+        this_year : int
+            The current year. Files modified in other years show the year
+            instead of the time. Looked up if not given.
+
         """
 
-        self.get_long_info()
+        if self.filemode_str is None:
+            self.get_long_info()
 
         name = self.name
-        link_padded = str(self.num_links).rjust(link_width)
+        link_padded = self.num_links_str.rjust(link_width)
         owner_padded = self.owner.rjust(owner_width)
         group_padded = self.group.rjust(group_width)
-        size_padded = str(self.size).rjust(size_width)
+        size_padded = self.size_str.rjust(size_width)
 
         if self.file_type is FileType.DIR:
-            name = Color.BOLD.value + Color.BLUE.value + name + Color.END.value
+            name = self.styled_name
 
         if self.file_type is FileType.LNK:
-            name = "{} -> {}".format(name, self.path.resolve())
-
-        file_year = datetime.date.fromtimestamp(self.mtime).year
-        this_year = datetime.date.today().year
-        if file_year == this_year:
-            timestamp = datetime.datetime.fromtimestamp(self.mtime).strftime("%b %d %H:%M")
+            # Like ls, show the link's stored target rather than resolving
+            # the whole chain.
+            try:
+                name = "{} -> {}".format(name, os.readlink(self.path))
+            except OSError:
+                pass
+
+        if this_year is None:
+            this_year = time.localtime().tm_year
+        mtime = time.localtime(self.mtime)
+        if mtime.tm_year == this_year:
+            timestamp = time.strftime("%b %d %H:%M", mtime)
         else:
-            timestamp = datetime.datetime.fromtimestamp(self.mtime).strftime("%b %d") + " " + str(file_year).rjust(5)
+            timestamp = time.strftime("%b %d", mtime) + " " + str(mtime.tm_year).rjust(5)
 
         params = [self.filemode_str, link_padded, owner_padded, group_padded,
                   size_padded, timestamp, name]
@@ -180,12 +283,38 @@ class FileInfo:
 
         """
 
-        if not include_hidden:
-            children = [FileInfo(child) for child in self.path.iterdir() if not child.name.startswith('.')]
-        else:
-            children = [FileInfo(child) for child in self.path.iterdir()]
+        with os.scandir(self.path) as entries:
+            if not include_hidden:
+                children = [FileInfo(entry) for entry in entries if entry.name[0] != '.']
+            else:
+                children = [FileInfo(entry) for entry in entries]
         return children
 
+    def get_child_names(self, include_hidden=False):
+        """Get the names of the files in this directory.
+
+        Unlike get_children, this only reads the directory itself and never
+        stats the entries.
+
+        Parameters
+        ----------
+        include_hidden: Bool
+            Whether to include files whose names start with '.'
+
+        Returns
+        -------
+        names : list
+            List of file names.
+
+        """
+
+        with os.scandir(self.path) as entries:
+            if not include_hidden:
+                names = [entry.name for entry in entries if entry.name[0] != '.']
+            else:
+                names = [entry.name for entry in entries]
+        return names
+
 
 def process_args():
     """Specify and parse command line arguments.
@@ -217,10 +346,17 @@ def process_args():
         required=False,
         help="use a long listing format")
 
+    parser.add_argument(
+        "--parallel",
+        action="store_true",
+        required=False,
+        help="fetch long listing metadata concurrently, "
+             "for directories on network filesystems")
+
     parser.add_argument(
         "filenames",
         nargs='*',
-        default='.',
+        default=['.'],
         type=str,
         metavar="FILE",
         help="a space-separated list of files to display")
@@ -228,75 +364,144 @@ def process_args():
     namespace = parser.parse_args()
     return namespace
 
-def print_normal(file, include_hidden):
+def format_normal(file, include_hidden, column_count=80):
     """If the given file is a directory, list its children.
 
     Paramaters
     ---------
     file : FileInfo
-        The file to check. If it's a directory, print its children.
-        Otherwise, print its name.
+        The file to check. If it's a directory, list its children.
+        Otherwise, list its name.
 
     include_hidden : Bool
         Whether to include files whose names start with ','
 
+    column_count : int
+        Width of the terminal, used to lay the names out in rows.
+
+    Returns
+    -------
+    output : string
+        The text to display, ending in a newline.
+
     """
 
-    if not file.path.is_dir():
-        print(file.styled_name)
-        return
+    if not os.path.isdir(file.path):
+        return file.styled_name + "\n"
 
-    children = file.get_children(include_hidden)
-    children.sort(key=lambda child: child.name.lower().strip('.'))
-    max_name_length = len(max([child.name for child in children], key=len))
-    names = [(child.name).ljust(max_name_length) for child in children]
+    names = file.get_child_names(include_hidden)
+    if not names:
+        return ""
+    names.sort(key=get_sort_key)
+    max_name_length = max(len(name) for name in names)
+
+    # Lay the names out in rows directly, two spaces apart. Padding is
+    # applied lazily per row so no padded copy of the list is kept. The
+    # last name in a row needs no separator, hence the extra 2 columns.
+    names_per_row = max(1, (column_count + 2) // (max_name_length + 2))
+    rows = ("  ".join(name.ljust(max_name_length)
+                      for name in names[i:i + names_per_row]).rstrip()
+            for i in range(0, len(names), names_per_row))
+    return "\n".join(rows) + "\n"
+
+def get_long_widths(files):
+    """Find the column widths needed to align files in long format.
+
+    Parameters
+    ----------
+    files : iterable
+        FileInfo objects whose long info has been fetched.
+
+    Returns
+    -------
+    widths : tuple
+        The link count, owner, group, and size widths, in that order.
 
+    """
+
+    # Bind builtins to locals; this loop runs once per file.
+    _len = len
+    _max = max
+    max_links_width = max_owner_width = max_group_width = max_size_width = 0
+    for file in files:
+        max_links_width = _max(max_links_width, _len(file.num_links_str))
+        max_owner_width = _max(max_owner_width, _len(file.owner))
+        max_group_width = _max(max_group_width, _len(file.group))
+        max_size_width = _max(max_size_width, _len(file.size_str))
+    return max_links_width, max_owner_width, max_group_width, max_size_width
+
+def format_long(file, include_hidden, parallel=False):
+    """Format the given file in long format. If it's a directory, list
+    its children in long format instead.
 
-    column_count, row_count = shutil.get_terminal_size()
-    print(textwrap.fill("\n".join(names), column_count))
+    Paramaters
+    ---------
+    file : FileInfo
+        The file to format.
+
+    include_hidden : Bool
+        Whether to include files whose names start with '.'
+
+    parallel : Bool
+        Whether to fetch metadata for large directories concurrently.
+
+    Returns
+    -------
+    output : string
+        The text to display, ending in a newline.
+
+    """
+
+    if not os.path.isdir(file.path):
+        return file.get_long_str() + "\n"
+
+    children = file.get_children(include_hidden)
+    if not children:
+        return ""
+    children.sort(key=operator.attrgetter('sort_key'))
+
+    # Metadata is fetched and measured in the same pass over the children.
+    if parallel and len(children) > PARALLEL_THRESHOLD:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            widths = get_long_widths(executor.map(FileInfo.get_long_info, children))
+    else:
+        widths = get_long_widths(map(FileInfo.get_long_info, children))
+
+    # Build the whole listing in one buffer so it is written in one go.
+    this_year = time.localtime().tm_year
+    out = io.StringIO()
+    write = out.write
+    get_long_str = FileInfo.get_long_str
+    for child in children:
+        write(get_long_str(child, *widths, this_year))
+        write("\n")
+    return out.getvalue()
 
 def main():
     """Main entry point for the program."""
 
     args = process_args()
-
-    for filename in args.filenames:
-        current_file = FileInfo(filename)
-        print_normal(current_file, args.all)
-
-    # multiple_dirs = len(args.files) > 1
-    # files = []
-
-    # for file in args.filenames:
-    #     files.append(FileInfo(file))
-
-    # if args.long:
-    #     for file in files:
-    #         file.get_long_info()
-
-    # max_links_width = len(max([str(file.num_links) for file in files], key=len))
-    # max_owner_width = len(max([file.owner for file in files], key=len))
-    # max_group_width = len(max([file.group for file in files], key=len))
-    # max_size_width = len(max([str(file.size) for file in files], key=len))
-
-    # column_count, row_count = shutil.get_terminal_size()
-
-    # if args.long:
-    #     for file in files:
-    #         children = file.get_children(args.all)
-    #         children.sort(key=lambda child: child.name.lower().strip('.'))
-
-    #         for child in children:
-    #             out_str = child.get_long_str(max_links_width, max_owner_width,
-    #                                          max_group_width, max_size_width)
-    #             print(out_str)
-    # else:
-    #     for file in files:
-    #         children = file.get_children(args.all)
-    #         children.sort(key=lambda child: child.name.lower().strip('.'))
-    #         max_filename_len = len(max([child.name for child in children], key=len))
-    #         padded_names = [child.name.ljust(max_filename_len) for child in children]
-    #         print(textwrap.fill("\n".join(padded_names), column_count))
+    if args.long:
+        format_file = functools.partial(format_long, include_hidden=args.all,
+                                        parallel=args.parallel)
+    else:
+        column_count, row_count = shutil.get_terminal_size()
+        format_file = functools.partial(format_normal, include_hidden=args.all,
+                                        column_count=column_count)
+
+    def list_file(filename):
+        return format_file(FileInfo(filename))
+
+    # Several arguments are listed concurrently, but written in the order
+    # they were given. The long format already uses its own pool for large
+    # directories, so it lists arguments serially rather than nesting pools.
+    if len(args.filenames) > 1 and not args.long:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for output in executor.map(list_file, args.filenames):
+                sys.stdout.write(output)
+    else:
+        for filename in args.filenames:
+            sys.stdout.write(list_file(filename))
 
 
 if __name__ == "__main__":